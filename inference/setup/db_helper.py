@@ -5,14 +5,21 @@ postgres database.
 
 import json
 from collections import namedtuple
+from functools import cache
 from typing import Dict
 
 import boto3
 import psycopg
+from psycopg import sql
+from psycopg_pool import ConnectionPool
 
 DROUGHTWATCH_DB = "droughtwatch"
 LEDGER = "ledger"
 METRICS = "metrics"
+# Most connections a single lambda keeps open to the database
+POOL_MAX_SIZE = 4
+# The (database, create table statement) pairs this lambda container has set up
+_PREPARED_DBS = set()
 
 
 def get_credentials(endpoint_url: str | None = None) -> Dict[str, str]:
@@ -37,6 +44,20 @@ def get_credentials(endpoint_url: str | None = None) -> Dict[str, str]:
     return db_config
 
 
+@cache
+def get_db_config(endpoint_url: str | None = None) -> Dict[str, str]:
+    """Get the DB credentials, but only ask AWS secrets manager for them once
+    per lambda container, so that warm invocations reuse them.
+
+    Args:
+        endpoint_url (str | None, optional): The endpoint url to use. Defaults to None.
+
+    Returns:
+        Dict[str, str]: The DB secrets
+    """
+    return get_credentials(endpoint_url=endpoint_url)
+
+
 def get_db_connection_string(db_config: Dict[str, str | int | float]) -> str:
     """Construct a postgres connection string to be used with  psycopg to
     connect to the database
@@ -57,17 +78,43 @@ def get_db_connection_string(db_config: Dict[str, str | int | float]) -> str:
     return connection_string
 
 
+@cache
+def get_db_pool(connection_string: str) -> ConnectionPool:
+    """Get a pool of connections to the database. The pool is created once per
+    lambda container and its connections are reused by warm invocations. They are
+    checked before being handed out, since they may have been dropped while the
+    lambda was frozen.
+
+    Args:
+        connection_string (str): String to connect to postgres db
+
+    Returns:
+        ConnectionPool: The pool of autocommit connections
+    """
+    return ConnectionPool(
+        connection_string,
+        min_size=1,
+        max_size=POOL_MAX_SIZE,
+        kwargs={"autocommit": True},
+        check=ConnectionPool.check_connection,
+        open=True,
+    )
+
+
 def prep_db(
     db_config: Dict[str, str], db_name: str, create_table_statement: str
 ) -> None:
     """Check if a database exists and if it does not, create it, along with the
-    ledger table
+    ledger table. This only runs once per lambda container, so that warm
+    invocations do not open any extra connections.
 
     Args:
         db_config (Dict[str, str]): The db configuration
         db_name (str): Name of the database to create
         create_table_statement (str): The actual SQL statement to execute
     """
+    if (db_name, create_table_statement) in _PREPARED_DBS:
+        return
     host = db_config["host"]
     port = db_config["port"]
     user = db_config["username"]
@@ -83,34 +130,32 @@ def prep_db(
             f"host={host} port={port} dbname={db_name} user={user} password={password}"
         ) as conn:
             conn.execute(create_table_statement)
+    _PREPARED_DBS.add((db_name, create_table_statement))
 
 
 SqlUpdate = namedtuple("SqlUpdate", ["field", "value"])
+SqlCondition = namedtuple("SqlCondition", ["field", "value"])
 
 
 def update_table(
-    table: str, update: SqlUpdate, cond: str, db_config: Dict[str, str]
+    table: str, update: SqlUpdate, cond: SqlCondition, conn: psycopg.Connection
 ) -> None:
-    """Generate SQL code to update a certain column in a given table and database
+    """Generate SQL code to update a certain column in a given table and database.
+    The values are sent as parameters, so the statement is the same for every row
+    and can be prepared once per connection.
 
     Args:
         table (str): The table to update
-        db_name (str): The DB with the desired table
-        update (_type_): The SqlUpdate object describing the update
-        cond (str): The condition describing which rows to update
-        db_config (Dict[str, str]): The DB config
+        update (SqlUpdate): The SqlUpdate object describing the update
+        cond (SqlCondition): The column and value selecting which rows to update
+        conn (psycopg.Connection): Connection to the DB with the desired table
     """
 
-    sql_cmd = f"""
-UPDATE {table}
-SET {update.field} = '{update.value}'
-WHERE {cond}
-"""
-    connection_string = get_db_connection_string(db_config)
-    with psycopg.connect(  # pylint: disable=E1129
-        connection_string,
-        autocommit=True,
-    ) as conn:
-        with conn.cursor() as curr:
-            print(sql_cmd)
-            curr.execute(sql_cmd)
+    sql_cmd = sql.SQL("update {table} set {field} = %s where {cond} = %s").format(
+        table=sql.Identifier(table),
+        field=sql.Identifier(update.field),
+        cond=sql.Identifier(cond.field),
+    )
+    with conn.cursor() as curr:
+        print(sql_cmd.as_string(conn), (update.value, cond.value))
+        curr.execute(sql_cmd, (update.value, cond.value), prepare=True)
@@ -18,9 +18,11 @@ import psycopg
 import tensorflow as tf
 from db_helper import (
     LEDGER,
+    SqlCondition,
     SqlUpdate,
-    get_credentials,
+    get_db_config,
     get_db_connection_string,
+    get_db_pool,
     update_table,
 )
 from omegaconf import DictConfig, OmegaConf
@@ -186,22 +188,18 @@ def package_predictions(
     return df
 
 
-def get_new_cases(connection_string: str) -> List[str]:
+def get_new_cases(conn: psycopg.Connection) -> List[str]:
     """Find all cases where the processed data exists but no predictions
     are available.
 
     Args:
-        db_config (Dict[str, str  |  int  |  float]): Database config
+        conn (psycopg.Connection): Connection to the postgres db
 
     Returns:
         List[str]: Names of all the processed files with no predictions
     """
-    with psycopg.connect(  # pylint: disable=E1129
-        connection_string,
-        autocommit=True,
-    ) as conn:
-        df = pd.read_sql(f'select * from "{LEDGER}"', conn)
-        new_cases = df[(df["processed_path"].notna()) & (df["predictions_path"].isna())]
+    df = pd.read_sql(f'select * from "{LEDGER}"', conn)
+    new_cases = df[(df["processed_path"].notna()) & (df["predictions_path"].isna())]
     return new_cases["processed_path"].values
 
 
@@ -235,11 +233,13 @@ def lambda_handler(event, context) -> Dict[str, Any]:  # pylint: disable=unused-
         model, config = get_model(s3, s3_model_path)
 
         # Get new cases from ledger database
-        db_config = get_credentials(endpoint_url=AWS_ENDPOINT_URL)
-        connection_string = get_db_connection_string(db_config)
+        db_config = get_db_config(endpoint_url=AWS_ENDPOINT_URL)
+        pool = get_db_pool(get_db_connection_string(db_config))
+        with pool.connection() as conn:
+            new_cases = get_new_cases(conn)
 
         # For every case that does not have predictions, run the model
-        for key in get_new_cases(connection_string):
+        for key in new_cases:
             name = os.path.basename(key)
             base_dir = os.path.dirname(key)
             with tempfile.TemporaryDirectory() as tmpdirname:
@@ -266,8 +266,9 @@ def lambda_handler(event, context) -> Dict[str, Any]:  # pylint: disable=unused-
                 )
             # Update the ledger, recording that this file has predictions
             u = SqlUpdate("predictions_path", predictions_path)
-            cond = f"processed_path='{key}'"
-            update_table("ledger", u, cond, db_config)
+            cond = SqlCondition("processed_path", key)
+            with pool.connection() as conn:
+                update_table("ledger", u, cond, conn)
         # Return a code for success and pass on the input event
         return {"statusCode": 200, "body": ev}
     except Exception as e:  # pylint: disable=W0718
@@ -1,36 +1,44 @@
 """
-This module contains the code that performs computes metrics on the
-predictions using Evidently for data drift.
+This module contains the code that computes metrics on the
+predictions, including the prediction drift, for model observability.
 """
 
 import datetime
 import json
 import os
 import traceback
-from collections import OrderedDict
-from typing import Any, Dict, Union
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import cache
+from typing import Any, List, Tuple
 
-import awswrangler as wr
-import pandas as pd
+import numpy as np
 import psycopg
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from db_helper import (
     DROUGHTWATCH_DB,
     LEDGER,
     METRICS,
-    get_credentials,
+    get_db_config,
     get_db_connection_string,
+    get_db_pool,
     prep_db,
 )
-from evidently import ColumnMapping
-from evidently.metrics import (
-    ColumnDriftMetric,
-    ColumnSummaryMetric,
-    DatasetMissingValuesMetric,
-)
-from evidently.report import Report
+from psycopg import sql
+from pyarrow import fs
+from scipy.spatial import distance
 
 AWS_ENDPOINT_URL = os.getenv("aws_endpoint_url")
 
+# Native Arrow S3 client, shared by every read in this module
+S3_FS = fs.S3FileSystem(endpoint_override=AWS_ENDPOINT_URL)
+# Number of predictions files that are observed concurrently
+MAX_WORKERS = 8
+# 4 possible classes
+NUM_CLASSES = 4
+
 
 CREATE_TABLE_STATEMENT = """
 create table if not exists metrics(
@@ -45,108 +53,203 @@ create table if not exists metrics(
     prediction_drift float
 )
 """
-num_features = ["P_0", "P_1", "P_2", "P_3", "P_label"]
-column_mapping = ColumnMapping(
-    target=None, prediction="label", numerical_features=num_features
+
+# Column order of the rows written to the metrics table
+METRICS_COLUMNS = (
+    "predictions_path",
+    "timestamp",
+    "class_0_frac",
+    "class_1_frac",
+    "class_2_frac",
+    "class_3_frac",
+    "most_common_percentage",
+    "share_missing_values",
+    "prediction_drift",
 )
+# Built once, so that every insert sends the same statement and the server can
+# reuse its prepared plan
+METRICS_INSERT_SQL = sql.SQL("insert into {table} ({fields}) values ({values})").format(
+    table=sql.Identifier(METRICS),
+    fields=sql.SQL(", ").join(map(sql.Identifier, METRICS_COLUMNS)),
+    values=sql.SQL(", ").join(sql.Placeholder() * len(METRICS_COLUMNS)),
+)
+# The metrics of one predictions file, in the same order as the table columns
+Metrics = namedtuple("Metrics", METRICS_COLUMNS[1:])
 
 
-def insert_row_into_table(
-    curr: psycopg.Cursor, row: Dict[str, Any], table_name: str
-) -> None:
-    """Insert a given row into the PostgreSQL table
+def insert_metrics_row(curr: psycopg.Cursor, row: Tuple[Any, ...]) -> None:
+    """Insert a single row into the metrics table. Inside the connection's
+    pipeline this only queues the insert, without waiting on the server. The
+    insert is prepared, and pooled connections keep it between invocations.
 
     Args:
         curr (psycopg.Cursor): The current cursor
-        row (Dict[str, Any]): The row to insert
-        table_name (str): The table into which to insert the row
+        row (Tuple[Any, ...]): The row to insert, with values in the order of
+            METRICS_COLUMNS
+    """
+    curr.execute(METRICS_INSERT_SQL, row, prepare=True)
+
+
+def read_parquet_from_s3(
+    bucket_name: str, key: str, columns: List[str] | None = None
+) -> pa.Table:
+    """Read a parquet file from S3 using Arrow's native S3 filesystem. The data
+    is kept as an Arrow table, since the metrics only need column aggregates.
+
+    Args:
+        bucket_name (str): The bucket holding the file
+        key (str): The key of the parquet file
+        columns (List[str] | None, optional): Only read these columns.
+            Defaults to None, which reads all of them.
+
+    Returns:
+        pa.Table: The contents of the file
+    """
+    return pq.read_table(
+        f"{bucket_name}/{key}",
+        columns=columns,
+        filesystem=S3_FS,
+        use_threads=True,
+        pre_buffer=True,
+    )
+
+
+def class_fractions(labels: np.ndarray) -> np.ndarray:
+    """Compute the fraction of each class, including the ones that never appear
+
+    Args:
+        labels (np.ndarray): The predicted labels
+
+    Returns:
+        np.ndarray: The fraction of each class, of length NUM_CLASSES
+    """
+    counts = np.bincount(labels, minlength=NUM_CLASSES)
+    return counts / counts.sum()
+
+
+@cache
+def reference_fractions(bucket_name: str, key: str) -> np.ndarray:
+    """Compute the class fractions of the reference data. The reference data
+    does not change, so it is only read once per lambda container and warm
+    invocations reuse the result.
+
+    Args:
+        bucket_name (str): The bucket holding the reference data
+        key (str): The key of the reference parquet file
+
+    Returns:
+        np.ndarray: The fraction of each class, of length NUM_CLASSES
     """
-    ks = row.keys()
-    fields = ", ".join(ks)
-    values = [row[k] for k in ks]
-    pls = ", ".join(["%s"] * len(ks))
-    sql_cmd = f"insert into {table_name}({fields}) values ({pls})"
-    curr.execute(sql_cmd, values)
+    ref_table = read_parquet_from_s3(bucket_name, key, columns=["label"])
+    return class_fractions(ref_table["label"].to_numpy())
 
 
-def extract_metric_data(result: Dict[str, Any]) -> Dict[str, Union[int, float, str]]:
-    """Extract the numbers relevant to each metric
+def prediction_drift(current_fracs: np.ndarray, ref_fracs: np.ndarray) -> float:
+    """Compute the drift of the predicted labels as the Jensen-Shannon distance
+    between the class distributions. This is the test Evidently used by default
+    for a categorical column with more than 1000 reference rows.
 
     Args:
-        result (Dict[str, Any]): The result dict from evidently
+        current_fracs (np.ndarray): The class fractions of the latest data
+        ref_fracs (np.ndarray): The class fractions of the training data
 
     Returns:
-        Dict[str, Union[int, float, str]]: A dictionary of the metrics
+        float: The drift score
     """
-    result_metrics = OrderedDict()
-    metrics = result["metrics"]
-
-    result_metrics["share_missing_values"] = metrics[0]["result"]["current"][
-        "share_of_missing_values"
-    ]
-    result_metrics["most_common_percentage"] = metrics[1]["result"][
-        "current_characteristics"
-    ]["most_common_percentage"]
-    result_metrics["prediction_drift"] = metrics[2]["result"]["drift_score"]
-    return result_metrics
-
-
-def compute_metrics(
-    current_data: pd.DataFrame, ref_data: pd.DataFrame
-) -> Dict[str, float | int]:
+    return float(distance.jensenshannon(ref_fracs, current_fracs))
+
+
+def share_missing_values(data: pa.Table) -> float:
+    """Compute the share of all the cells in the data that are missing. Like
+    Evidently's DatasetMissingValuesMetric, nulls, NaNs, empty strings and
+    infinities all count as missing.
+
+    Args:
+        data (pa.Table): The data to check
+
+    Returns:
+        float: The share of missing cells
+    """
+    size = data.num_rows * data.num_columns
+    if size == 0:
+        return 0.0
+    missing = 0
+    for column in data.itercolumns():
+        # pyarrow.compute generates its functions at import time
+        # pylint: disable=no-member
+        is_missing = pc.is_null(column, nan_is_null=True)
+        if pa.types.is_floating(column.type):
+            is_missing = pc.or_kleene(is_missing, pc.is_inf(column))
+        elif pa.types.is_string(column.type) or pa.types.is_large_string(column.type):
+            is_missing = pc.or_kleene(is_missing, pc.equal(column, ""))
+        missing += pc.sum(is_missing).as_py()
+    return missing / size
+
+
+def compute_metrics(current_data: pa.Table, ref_fracs: np.ndarray) -> Metrics:
     """Compute various metrics for the prediction and data
 
     Args:
-        current_data (pd.DataFrame): The latest data
-        ref_data (pd.DataFrame): The training data
+        current_data (pa.Table): The latest data
+        ref_fracs (np.ndarray): The class fractions of the training data
 
     Returns:
-        Dict[str, float | int]: The dict of metrics
+        Metrics: The metrics
     """
-    # Generate the report
-    report = Report(
-        metrics=[
-            DatasetMissingValuesMetric(),
-            ColumnSummaryMetric(column_name="label"),
-            ColumnDriftMetric(column_name="label"),
-        ]
-    )
-    report.run(
-        reference_data=ref_data,
-        current_data=current_data,
-        column_mapping=column_mapping,
+    # Same helper as for the reference data, so both are summarised identically
+    fracs = class_fractions(current_data["label"].to_numpy())
+    return Metrics(
+        timestamp=datetime.datetime.now(),
+        class_0_frac=float(fracs[0]),
+        class_1_frac=float(fracs[1]),
+        class_2_frac=float(fracs[2]),
+        class_3_frac=float(fracs[3]),
+        # Percentage of the most common class, rounded as Evidently did
+        most_common_percentage=float(np.round(100 * fracs.max(), 2)),
+        share_missing_values=share_missing_values(current_data),
+        prediction_drift=prediction_drift(fracs, ref_fracs),
     )
-    result = report.as_dict()
-    metrics = extract_metric_data(result)
 
-    props = current_data["label"].value_counts() / current_data["label"].count()
-    # metrics.update(**{f"class_{k}_frac": v for k, v in props.to_dict().items()})
-    metrics.update({f"class_{k}_frac": v for k, v in props.items()})
-    metrics["timestamp"] = datetime.datetime.now()
 
-    return metrics
+def observe_prediction(
+    bucket_name: str, prediction: str, ref_fracs: np.ndarray
+) -> Tuple[Any, ...]:
+    """Read a single predictions file and compute its metrics
+
+    Args:
+        bucket_name (str): The data bucket
+        prediction (str): The key of the predictions file
+        ref_fracs (np.ndarray): The class fractions of the training data
+
+    Returns:
+        Tuple[Any, ...]: The row to insert into the metrics table
+    """
+    table = read_parquet_from_s3(bucket_name, prediction)
+    return (prediction, *compute_metrics(table, ref_fracs))
 
 
-def get_new_predictions(connection_string: str) -> set:
+def get_new_predictions(conn: psycopg.Connection) -> set:
     """Find all prediction files that no metrics computed by comparing
     the ledger and metrics tables.
 
     Args:
-        connection_string (str): String to connect to postgres db
+        conn (psycopg.Connection): Connection to the postgres db
 
     Returns:
         set: The files that have not been observed
     """
-    with psycopg.connect(  # pylint: disable=E1129
-        connection_string,
-        autocommit=True,
-    ) as conn:
-        df_ledger = pd.read_sql(f'select * from "{LEDGER}"', conn)
-        df_metrics = pd.read_sql(f'select * from "{METRICS}"', conn)
-        new_items = set(df_ledger["predictions_path"].values) - set(
-            df_metrics["predictions_path"]
-        )
-        return new_items
+    # Let postgres do the set difference so we only get the new paths back
+    sql_cmd = f"""
+select distinct l.predictions_path from "{LEDGER}" l
+where l.predictions_path is not null
+and not exists (
+    select 1 from "{METRICS}" m where m.predictions_path = l.predictions_path
+)
+"""
+    with conn.cursor() as curr:
+        curr.execute(sql_cmd)
+        new_items = {row[0] for row in curr.fetchall()}
+    return new_items
 
 
 def lambda_handler(event, context):  # pylint: disable=unused-argument
@@ -155,7 +258,8 @@ def lambda_handler(event, context):  # pylint: disable=unused-argument
 
     - Creates the metrics table, if it doesn't exist
     - Finds all predictions files that are not in the metrics table
-    - Loops over them, compute metrics and write those to metrics table
+    - Computes metrics for them concurrently
+    - Streams the metrics to the metrics table in a single pipeline
     Args:
         event
         context
@@ -166,33 +270,29 @@ def lambda_handler(event, context):  # pylint: disable=unused-argument
     try:
         bucket_name = event["body"]["data_bucket_name"]
 
-        if AWS_ENDPOINT_URL is not None:
-            wr.config.s3_endpoint_url = AWS_ENDPOINT_URL
-
         reference_data_path = os.getenv("reference_path", "reference_data.parquet")
-        db_config = get_credentials(endpoint_url=AWS_ENDPOINT_URL)
+        db_config = get_db_config(endpoint_url=AWS_ENDPOINT_URL)
 
         prep_db(db_config, DROUGHTWATCH_DB, CREATE_TABLE_STATEMENT)
 
-        connection_string = get_db_connection_string(db_config)
-        # We get the unobserved cases
-        predictions_list = get_new_predictions(connection_string)
-        with psycopg.connect(  # pylint: disable=E1129
-            connection_string,
-            autocommit=True,
-        ) as conn:
-            for prediction in predictions_list:
-                # Compute the metrics we want
-                df = wr.s3.read_parquet(path=f"s3://{bucket_name}/{prediction}")
-                df_ref = wr.s3.read_parquet(
-                    path=f"s3://{bucket_name}/{reference_data_path}"
-                )
-                metrics = OrderedDict()
-                metrics.update(predictions_path=prediction)
-                metrics.update(**compute_metrics(df, df_ref))
-
-                with conn.cursor() as curr:
-                    insert_row_into_table(curr, metrics, "metrics")
+        pool = get_db_pool(get_db_connection_string(db_config))
+        with pool.connection() as conn:
+            # We get the unobserved cases
+            predictions_list = get_new_predictions(conn)
+            # The reference data is the same for every prediction, so summarise it once
+            ref_fracs = reference_fractions(bucket_name, reference_data_path)
+            # Every predictions file is independent, so observe them in parallel.
+            # Only the main thread touches the database: each row is queued in the
+            # pipeline as soon as it is ready, and we only wait for the server
+            # once, when the pipeline is synced on exit.
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                futures = [
+                    executor.submit(observe_prediction, bucket_name, p, ref_fracs)
+                    for p in predictions_list
+                ]
+                with conn.pipeline(), conn.cursor() as curr:
+                    for future in as_completed(futures):
+                        insert_metrics_row(curr, future.result())
         return {"statusCode": 200, "body": "Updated observation table"}
     except Exception as e:  # pylint: disable=W0718
         # Something has gone wrong, capture the traceback
@@ -7,24 +7,46 @@ import json
 import os
 import tempfile
 import traceback
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Tuple
 
 import boto3
-import pandas as pd
 import psycopg
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from db_helper import (
     DROUGHTWATCH_DB,
     LEDGER,
+    SqlCondition,
     SqlUpdate,
-    get_credentials,
+    get_db_config,
     get_db_connection_string,
+    get_db_pool,
     prep_db,
     update_table,
 )
 from parse_data import process_one_dataset
+from psycopg import sql
+from psycopg_pool import ConnectionPool
 
 AWS_ENDPOINT_URL = os.getenv("aws_endpoint_url")
 
+# Number of threads used by each transfer
+MAX_CONCURRENCY = 10
+# Use multipart, multi-threaded transfers for the (large) raw and processed files
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=MAX_CONCURRENCY,
+    use_threads=True,
+)
+# Number of raw files that are processed concurrently
+MAX_WORKERS = 4
+# Every concurrent file transfers with several threads through the same client, so
+# its connection pool must hold all of them
+S3_CLIENT_CONFIG = Config(max_pool_connections=MAX_WORKERS * MAX_CONCURRENCY)
+
 
 CREATE_TABLE_STATEMENT = """
 create table if not exists ledger(
@@ -36,69 +58,123 @@ create table if not exists ledger(
 )
 """
 
+# Register all the candidate raw files in one statement, which returns the paths
+# that were added. Files already in the ledger are skipped unless forced. The
+# statement never changes, so it is only parsed and planned once per connection.
+LEDGER_INSERT_SQL = sql.SQL(
+    """
+insert into {table} (md5sum, raw_path)
+select t.md5sum, t.raw_path
+from unnest(%s::text[], %s::text[]) as t(md5sum, raw_path)
+where %s or not exists (
+    select 1 from {table} l where l.raw_path = t.raw_path
+)
+returning raw_path
+"""
+).format(table=sql.Identifier(LEDGER))
+
 
-def get_raw_data_names(bucket_name: str) -> List[str]:
-    """Find all raw data files in the bucket
+def get_raw_data_names(bucket_name: str, prefix: str = "") -> List[Tuple[str, str]]:
+    """Find all raw data files in the bucket, along with their md5sums.
+    The md5sum is the ETag that the listing already returns for every object.
 
     Args:
         bucket_name (str): The bucket to check
+        prefix (str, optional): Only look at keys under this prefix.
+            Defaults to "", i.e. the whole bucket.
 
     Returns:
-        List(str): List of raw files
+        List[Tuple[str, str]]: List of (raw file name, md5sum) pairs
     """
-    s3 = boto3.resource("s3", endpoint_url=AWS_ENDPOINT_URL)
+    s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL)
+    paginator = s3.get_paginator("list_objects_v2")
     # Get a list of all keys which we know are not products
-    s3_bucket = s3.Bucket(bucket_name)
-    names = [x.key for x in s3_bucket.objects.filter()]
-    names = [x for x in names if ("processed" not in x) and ("parquet" not in x)]
+    names = []
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        names.extend(
+            (obj["Key"], obj["ETag"].strip('"'))
+            for obj in page.get("Contents", [])
+            if ("processed" not in obj["Key"]) and ("parquet" not in obj["Key"])
+        )
     return names
 
 
 def prep_ledger(
-    db_config: Dict[str, str | int | float],
-    key_list: List[str],
-    bucket_name: str,
+    conn: psycopg.Connection,
+    key_list: List[Tuple[str, str]],
     forced: bool = False,
 ) -> List[str]:
-    """Prepare the ledger database table
+    """Prepare the ledger database table. Finding the new files and adding
+    them to the ledger takes a single round-trip.
 
     Args:
-        db_config (Dict[str, str  |  int  |  float]): Database configuration
-        key_list (List[str]): List of raw files names
-        bucket_name (str): The name of the data bucket
+        conn (psycopg.Connection): Connection to the postgres db
+        key_list (List[Tuple[str, str]]): List of (raw file name, md5sum) pairs
         forced (bool, optional): Force rerun. Defaults to False.
 
     Returns:
         List[str]: List of new raw files not found in ledger
     """
-    fields = "md5sum, raw_path"
-    s3_resource = boto3.resource("s3", endpoint_url=AWS_ENDPOINT_URL)
-    connection_string = get_db_connection_string(db_config)
-    with psycopg.connect(  # pylint: disable=E1129
-        connection_string,
-        autocommit=True,
-    ) as conn:
-        df = pd.read_sql(f'select * from "{LEDGER}"', conn)
-        if not forced:
-            new_items = set(key_list) - set(df["raw_path"].values)
-        else:
-            new_items = key_list
-        for item in new_items:
-            md5 = s3_resource.Object(bucket_name, item).e_tag.strip('"')
-            sql_cmd = f"insert into {LEDGER} ({fields}) values (%s, %s)"
-            values = [md5, item]
-            with conn.cursor() as curr:
-                curr.execute(sql_cmd, values)
+    md5sums = dict(key_list)
+    with conn.cursor() as curr:
+        curr.execute(
+            LEDGER_INSERT_SQL,
+            [list(md5sums.values()), list(md5sums), forced],
+            prepare=True,
+        )
+        new_items = [row[0] for row in curr.fetchall()]
     return new_items
 
 
+def process_raw_file(s3, bucket_name: str, key: str, pool: ConnectionPool) -> str:
+    """Process a single raw file, upload the result to S3 and
+    record it in the ledger
+
+    Args:
+        s3 (s3 client): The s3 client
+        bucket_name (str): The name of the data bucket
+        key (str): The key of the raw file
+        pool (ConnectionPool): Pool of connections to the postgres db
+
+    Returns:
+        str: The key of the processed file
+    """
+    name = os.path.basename(key)
+    base_dir = os.path.dirname(key)
+
+    with tempfile.TemporaryDirectory() as tmpdirname:
+        # Get the original dataset
+        tmp_file = os.path.join(tmpdirname, name)
+        with open(tmp_file, "w+b") as f:
+            s3.download_fileobj(bucket_name, key, f, Config=TRANSFER_CONFIG)
+
+        # This will create a processed file inside the temp directory
+        processed_file = process_one_dataset(tmp_file, assign_id=True)
+        processed_path = os.path.join(base_dir, os.path.basename(processed_file))
+        # Save the processed file to the S3 bucket
+        with open(processed_file, "rb") as f:
+            s3.upload_fileobj(
+                f,
+                bucket_name,
+                processed_path,
+                Config=TRANSFER_CONFIG,
+            )
+
+    # We managed to process things, let's update the ledger for corresponding item
+    u = SqlUpdate("processed_path", processed_path)
+    cond = SqlCondition("raw_path", key)
+    with pool.connection() as conn:
+        update_table("ledger", u, cond, conn)
+    return processed_path
+
+
 def lambda_handler(event, context):  # pylint: disable=unused-argument
     """Lambda handler for data processing. Performs the following
     actions:
 
     - Creates the ledger table, if it doesn't exist
     - Finds all raw files that don't have corresponding processed files
-    - Loops over them and processes them
+    - Processes them concurrently
     - Saves the processed files back to S3
     - Updates the ledger table to indicate which files have been
     processed
@@ -111,47 +187,29 @@ def lambda_handler(event, context):  # pylint: disable=unused-argument
         Dict[str,Any]:The body of the response in json form
     """
     try:
-        db_config = get_credentials(endpoint_url=AWS_ENDPOINT_URL)
+        db_config = get_db_config(endpoint_url=AWS_ENDPOINT_URL)
         prep_db(db_config, DROUGHTWATCH_DB, CREATE_TABLE_STATEMENT)
+        pool = get_db_pool(get_db_connection_string(db_config))
 
         bucket_name = event["data_bucket_name"]
         if AWS_ENDPOINT_URL is not None:
-            s3 = boto3.client("s3", endpoint_url=AWS_ENDPOINT_URL)
+            s3 = boto3.client(
+                "s3", endpoint_url=AWS_ENDPOINT_URL, config=S3_CLIENT_CONFIG
+            )
         else:
-            s3 = boto3.client("s3")
+            s3 = boto3.client("s3", config=S3_CLIENT_CONFIG)
 
         # Add anything new to the DB
-        names = get_raw_data_names(bucket_name)
-        new_items = prep_ledger(db_config, names, bucket_name)
-
-        # Loop over new stuff and process it
-        for key in new_items:
-            name = os.path.basename(key)
-            base_dir = os.path.dirname(key)
-
-            with tempfile.TemporaryDirectory() as tmpdirname:
-                # Get the original dataset
-                tmp_file = os.path.join(tmpdirname, name)
-                with open(tmp_file, "w+b") as f:
-                    s3.download_fileobj(bucket_name, key, f)
-
-                # This will create a processed file inside the temp directory
-                processed_file = process_one_dataset(tmp_file, assign_id=True)
-                processed_path = os.path.join(
-                    base_dir, os.path.basename(processed_file)
-                )
-                # Save the processed file to the S3 bucket
-                with open(processed_file, "rb") as f:
-                    s3.upload_fileobj(
-                        f,
-                        bucket_name,
-                        processed_path,
-                    )
-
-            # We managed to process things, let's update the ledger for corresponding item
-            u = SqlUpdate("processed_path", processed_path)
-            cond = f"raw_path = '{key}'"
-            update_table("ledger", u, cond, db_config)
+        raw_data_prefix = event.get("raw_data_prefix", os.getenv("raw_data_prefix", ""))
+        names = get_raw_data_names(bucket_name, prefix=raw_data_prefix)
+        with pool.connection() as conn:
+            new_items = prep_ledger(conn, names)
+
+        # Process the new files concurrently, so that the downloads, processing
+        # and uploads of different files overlap
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            process = partial(process_raw_file, s3, bucket_name, pool=pool)
+            list(executor.map(process, new_items))
 
         return {"statusCode": 200, "body": event}
     except Exception as e:  # pylint: disable=W0718
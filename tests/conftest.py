@@ -6,3 +6,14 @@ import os
 import sys
 
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# The lambda functions import their helpers as top-level modules, as they
+# do inside the Docker image, where parse_data sits next to them
+sys.path.insert(
+    0, os.path.abspath(os.path.join(os.path.dirname(__file__), '../inference/setup'))
+)
+sys.path.insert(
+    0,
+    os.path.abspath(
+        os.path.join(os.path.dirname(__file__), '../training/airflow/includes')
+    ),
+)
@@ -3,11 +3,14 @@ This module contains test of various functions  related to the
 inference pipeline.
 """
 
+import hashlib
+
 import boto3
 import pytest
 from moto import mock_aws
 
 from inference.setup.db_helper import get_credentials
+from inference.setup.lambda_function_processing import get_raw_data_names
 
 
 @pytest.fixture
@@ -35,3 +38,30 @@ def test_get_credentials(sample_secret):
     assert creds["password"] == "mlops4thewin"
     assert creds["host"] == "localhost"
     assert creds["port"] == "5432"
+
+
+@mock_aws
+def test_get_raw_data_names():
+    """
+    Test that only the raw data under the prefix is listed, along with
+    the md5sums taken from the ETags
+    """
+    s3 = boto3.client("s3")
+    s3.create_bucket(Bucket="droughtwatch-data")
+    keys = [
+        "sample_data/28_07_24/part-r-00012",
+        "sample_data/28_07_24/part-r-00013",
+        "sample_data/28_07_24/processed_part-r-00012",
+        "sample_data/28_07_24/predictions.parquet",
+        "reference_data.parquet",
+        "other_data/part-r-00014",
+    ]
+    for key in keys:
+        s3.put_object(Bucket="droughtwatch-data", Key=key, Body=key.encode())
+
+    names = get_raw_data_names("droughtwatch-data", prefix="sample_data/")
+
+    # The two raw files under the prefix, with the quotes stripped from the ETags
+    expected = {key: hashlib.md5(key.encode()).hexdigest() for key in keys[:2]}
+    assert dict(names) == expected
+    assert len(names) == 2
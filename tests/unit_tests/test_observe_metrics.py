@@ -0,0 +1,75 @@
+"""
+This module contains tests of the metrics computed by the observability
+lambda function.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from inference.setup.lambda_function_observe import (
+    class_fractions,
+    compute_metrics,
+    share_missing_values,
+)
+
+mpath = os.path.dirname(__file__)
+
+reference_data = os.path.join(
+    mpath,
+    "../integration_test_inference_pipeline/sample_data/reference",
+    "reference_data.parquet",
+)
+
+
+@pytest.fixture
+def current_data():  # pylint: disable=missing-function-docstring
+    # Same class distribution as the predictions in the integration test
+    labels = np.repeat([0, 1, 2, 3], [45, 6, 11, 17])
+    n = len(labels)
+    return pd.DataFrame(
+        {
+            "ID": [f"id_{i}" for i in range(n)],
+            "P_0": np.full(n, 0.25),
+            "P_1": np.full(n, 0.25),
+            "P_2": np.full(n, 0.25),
+            "P_3": np.full(n, 0.25),
+            "label": labels,
+            "P_label": np.full(n, 0.25),
+        }
+    )
+
+
+def test_compute_metrics(current_data):
+    """
+    Test that the metrics match the ones previously computed with Evidently
+    """
+    ref_table = pq.read_table(reference_data, columns=["label"])
+    ref_fracs = class_fractions(ref_table["label"].to_numpy())
+    metrics = compute_metrics(pa.Table.from_pandas(current_data), ref_fracs)
+
+    assert metrics.share_missing_values == 0.0
+    assert metrics.most_common_percentage == 56.96
+    assert metrics.prediction_drift == pytest.approx(0.1342082050295861)
+    assert metrics.class_0_frac == pytest.approx(0.569620253164557)
+    assert metrics.class_1_frac == pytest.approx(0.0759493670886076)
+    assert metrics.class_2_frac == pytest.approx(0.13924050632911392)
+    assert metrics.class_3_frac == pytest.approx(0.21518987341772153)
+
+
+def test_share_missing_values():
+    """
+    Test that nulls, NaNs, empty strings and infinities all count as missing
+    """
+    table = pa.table(
+        {
+            "ID": ["id_0", "", None, "id_3"],
+            "P_0": [0.25, np.nan, np.inf, -np.inf],
+            "label": [0, 1, None, 3],
+        }
+    )
+    assert share_missing_values(table) == pytest.approx(6 / 12)
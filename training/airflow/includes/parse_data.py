@@ -258,27 +258,48 @@ def read_raw_tfrecord(
 
 
 def read_processed_tfrecord(
-    path: List[str] | str,
+    path: List[str] | str | Dataset,
     keylist: List[str] | None = None,
     features: Dict[str, tf.io.FixedLenFeature] | None = None,
+    deterministic: bool | None = None,
 ) -> Dataset[Tuple[Tensor, Tensor]]:
     """Read one or many of the processed data files and convert them to format, suitable
     to training. In particular we have Tensors with shape (IMG_DIM,IMG_DIM,N_FEATURES)
-    where N_FEATURES is len(keylist)
+    where N_FEATURES is len(keylist). The records are parsed in parallel and, unless
+    the order has to be preserved, the files are read in parallel as well.
 
     Args:
-        path (str | List[str]): The path to the processed data.
+        path (str | List[str] | Dataset): The path to the processed data, or
+            a dataset of file names.
         keylist (List[str] | None, optional): The features to use. Defaults to None.
         features (Dict[str, tf.io.FixedLenFeature] | None, optional): Mapping of each
             feature inside the file. Defaults to None.
+        deterministic (bool | None, optional): Whether the reads must preserve the
+            order of the records. If so, the files are read one after the other, so
+            the records come in file order just like with a single TFRecordDataset.
+            Defaults to None, which preserves the order.
     Returns:
         Dataset: The parsed dataset, as a dataset of Tensors. The order of the last
         dimension is the same as the ordering of features in keylist.
     """
-    raw_dataset = tf.data.TFRecordDataset(path)
+    if isinstance(path, Dataset):
+        files = path
+    else:
+        if isinstance(path, str):
+            path = [path]
+        files = tf.data.Dataset.from_tensor_slices(tf.constant(path, dtype=tf.string))
+    raw_dataset = files.interleave(
+        tf.data.TFRecordDataset,
+        # Interleaving several files would mix up their records
+        cycle_length=tf.data.AUTOTUNE if deterministic is False else 1,
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=deterministic,
+    )
 
     parsed_dataset = raw_dataset.map(
-        partial(parse_tf_record, keylist=keylist, features=features)
+        partial(parse_tf_record, keylist=keylist, features=features),
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=deterministic,
     )
 
     return parsed_dataset
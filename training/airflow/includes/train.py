@@ -3,7 +3,6 @@ of experiments with either WandB or MLFlow. See the configuration
 options in setup/conf/training
 """
 
-import glob
 import logging
 import os
 import sys
@@ -20,6 +19,7 @@ from keras import layers
 from omegaconf import DictConfig
 from rich.logging import RichHandler
 from rich.traceback import install
+from sklearn.metrics import average_precision_score, precision_recall_curve
 from wandb.integration.keras import WandbMetricsLogger
 
 from . import parse_data
@@ -47,28 +47,40 @@ install()
 IMG_DIM = 65
 # 4 possible classes
 NUM_CLASSES = 4
-NUM_TRAIN = 500
-NUM_VAL = 320
 
 PROJECT_NAME = "droughtwatch_capstone"
 
 
 def get_dataset(
-    filelist: List[str],
+    file_pattern: str,
     batch_size: int,
     buffer_size: int,
     keylist: List[str] | None = None,
     shuffle: bool = True,
+    cache: bool = False,
+    drop_remainder: bool = False,
 ):
     """Return a batched and shuffled dataset. The input should correspond
-    to processed files.
+    to processed files. The records are read and parsed in parallel and the
+    batches are prefetched, so that the input pipeline overlaps with training.
+    The files are listed by TensorFlow itself. When shuffling, the order of the
+    files is shuffled every epoch, so the record-level shuffle buffer only needs to
+    mix nearby records. The exception is a cached dataset: the cache replays the
+    file order of the first epoch, so only the record-level shuffle buffer mixes
+    the records after that.
 
     Args:
-        filelist (List[str]): List of files comprising the processed TFRecords dataset
+        file_pattern (str): Glob pattern matching the files comprising the
+            processed TFRecords dataset
         batch_size (int): The batch size
         buffer_size (int): The buffer size for shuffling
         keylist (List[str], optional): The list of features to return.
         shuffle (bool, optional): Determines if we shuffle the dataset. Defaults to True.
+        cache (bool, optional): Keep the parsed records in memory after the first
+            epoch. The files are then no longer reshuffled every epoch.
+            Defaults to False.
+        drop_remainder (bool, optional): Drop the last, incomplete, batch so that
+            all batches have the same shape. Defaults to False.
 
     Returns:
         tf.Dataset: The dataset ready for training/validation
@@ -76,11 +88,17 @@ def get_dataset(
     if keylist is None:
         # Use RGB bands as default
         keylist = ["B2", "B3", "B4"]
-    dataset = parse_data.read_processed_tfrecord(filelist, keylist=keylist)
+    files = tf.data.Dataset.list_files(file_pattern, shuffle=shuffle)
+    # The order of the records only matters if we do not shuffle them anyway
+    dataset = parse_data.read_processed_tfrecord(
+        files, keylist=keylist, deterministic=not shuffle
+    )
+    if cache:
+        dataset = dataset.cache()
     if shuffle:
         dataset = dataset.shuffle(buffer_size)
-    dataset = dataset.batch(batch_size)
-    return dataset
+    dataset = dataset.batch(batch_size, drop_remainder=drop_remainder)
+    return dataset.prefetch(AUTOTUNE)
 
 
 def class_weights() -> Dict[int, float]:
@@ -103,6 +121,46 @@ def class_weights() -> Dict[int, float]:
     return class_weights_dict
 
 
+class PrecisionRecallCurves(keras.callbacks.Callback):
+    """Compute the precision-recall curve of every class on the validation
+    data at the end of every epoch and log them to WandB.
+    """
+
+    def __init__(self, dataset):
+        super().__init__()
+        self.dataset = dataset
+
+    def on_epoch_end(self, epoch, logs=None):
+        y_true = []
+        y_prob = []
+        for images, labels in self.dataset:
+            y_prob.append(self.model.predict_on_batch(images))
+            y_true.append(labels.numpy())
+        y_true = np.concatenate(y_true)
+        y_prob = np.concatenate(y_prob)
+
+        precisions = []
+        recalls = []
+        results = {}
+        for i in range(NUM_CLASSES):
+            precision, recall, _ = precision_recall_curve(y_true[:, i], y_prob[:, i])
+            precisions.append(precision)
+            recalls.append(recall)
+            results[f"epoch/val_ap_{i}"] = average_precision_score(
+                y_true[:, i], y_prob[:, i]
+            )
+        results["epoch/val_pr_curves"] = wandb.plot.line_series(
+            xs=recalls,
+            ys=precisions,
+            keys=[f"class_{i}" for i in range(NUM_CLASSES)],
+            title="Precision-recall",
+            xname="recall",
+        )
+        # Don't commit, so that these end up in the same step as the
+        # epoch metrics logged by WandbMetricsLogger
+        wandb.log(results, commit=False)
+
+
 def construct_baseline_model(cfg: DictConfig) -> keras.Sequential:
     """Construct a simple baseline CNN
 
@@ -114,6 +172,9 @@ def construct_baseline_model(cfg: DictConfig) -> keras.Sequential:
     """
     num_bands = len(cfg.features.list)
     lr = cfg.model.learning_rate
+    # Needs to be set before the layers are created. With a mixed policy the
+    # layers compute in half precision but keep their weights in float32
+    keras.mixed_precision.set_global_policy(cfg.model.precision_policy)
     model = keras.Sequential(
         [
             keras.Input(shape=[IMG_DIM, IMG_DIM, num_bands]),
@@ -130,28 +191,17 @@ def construct_baseline_model(cfg: DictConfig) -> keras.Sequential:
             layers.Flatten(),
             layers.Dense(units=50, activation="relu"),
             layers.Dropout(0.2),
-            layers.Dense(NUM_CLASSES, activation="softmax"),
+            # Keep the output in float32 so the loss is numerically stable
+            layers.Dense(NUM_CLASSES, activation="softmax", dtype="float32"),
         ]
     )
-    ths = list(np.arange(0, 0.99, 0.01))
-    metrics = []
-    # Compute precision and recall at every epoch for every class
-    if cfg.logging.style == "wandb":
-        for i in range(NUM_CLASSES):
-            name1 = f"pr_{i}"
-            name2 = f"re_{i}"
-            m1 = keras.metrics.Precision(thresholds=ths, class_id=i, name=name1)
-            m2 = keras.metrics.Recall(thresholds=ths, class_id=i, name=name2)
-            metrics.append(m1)
-            metrics.append(m2)
-
-    # Also compute accuracy
-    metrics.append("accuracy")
-
+    # Precision and recall are computed once per epoch by PrecisionRecallCurves,
+    # rather than being updated at many thresholds on every batch
     model.compile(
         loss="categorical_crossentropy",
         optimizer=keras.optimizers.Adam(learning_rate=lr),
-        metrics=metrics,
+        metrics=["accuracy"],
+        jit_compile=cfg.model.jit_compile,
     )
 
     return model
@@ -212,12 +262,24 @@ def train_cnn(cfg: DictConfig):
     logging_style = cfg.logging.style
 
     # load training data in TFRecord format
-    filelist = glob.glob(os.path.join(cfg.data.train_data, "processed_part*"))
-    train_dataset = get_dataset(filelist, batch_size, NUM_TRAIN, keylist=keylist)
+    train_dataset = get_dataset(
+        os.path.join(cfg.data.train_data, "processed_part*"),
+        batch_size,
+        cfg.data.shuffle_buffer_size,
+        keylist=keylist,
+        cache=cfg.data.cache,
+        drop_remainder=True,
+    )
 
-    # load validation data in TFRecord format
-    filelist = glob.glob(os.path.join(cfg.data.val_data, "processed_part*"))
-    val_dataset = get_dataset(filelist, batch_size, NUM_VAL, keylist=keylist)
+    # load validation data in TFRecord format, there is no need to shuffle it
+    val_dataset = get_dataset(
+        os.path.join(cfg.data.val_data, "processed_part*"),
+        batch_size,
+        cfg.data.shuffle_buffer_size,
+        keylist=keylist,
+        shuffle=False,
+        cache=cfg.data.cache,
+    )
 
     model = construct_baseline_model(cfg)
     run_name = f"{cfg.model.name}_{generate_random_id()}"
@@ -241,7 +303,7 @@ def train_cnn(cfg: DictConfig):
 
         wf_cfg = wandb.config
         wf_cfg.setdefaults(config)
-        callbacks = [WandbMetricsLogger()]
+        callbacks = [PrecisionRecallCurves(val_dataset), WandbMetricsLogger()]
 
     elif logging_style == "mlflow":
         # Do local MLFlow logging